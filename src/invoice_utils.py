@@ -1,11 +1,24 @@
 # src/invoice_utils.py
-import os, re, time, json
+import os, re, time, json, calendar
 from decimal import Decimal, ROUND_HALF_UP
 from typing import List, Dict, Any, Optional, Tuple
-from datetime import datetime, date, timedelta
-from functools import wraps
+from datetime import datetime, date
+from functools import wraps, lru_cache
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import httplib2
+import google_auth_httplib2
 from googleapiclient.errors import HttpError
 
+# ---------- compiled patterns (used in per-row loops) ----------
+_WS_RE = re.compile(r'\s+')
+_MASTER_RE = re.compile(r'master', re.I)
+_MONTH_RE1 = re.compile(r'^([A-Za-z]+)\s+(\d{4})$')
+_MONTH_RE2 = re.compile(r'^(\d{1,2})[\/\-](\d{4})$')
+_DIGITS_RE = re.compile(r'(\d+)')
+_UND_HYP_TT = str.maketrans('_-', '  ')
+_AMT_PARTS_RE = re.compile(r'(-?)(\d*)(?:\.(\d*))?')
+
 # ---------- utils ----------
 def retry(max_attempts=3, backoff=1.0):
     def deco(f):
@@ -23,21 +36,42 @@ def retry(max_attempts=3, backoff=1.0):
         return wrapper
     return deco
 
+def pad_rows(rows: List[List[Any]], n: int) -> List[List[Any]]:
+    # Sheets drops trailing empty cells; pad once per tab so row loops can index without len() guards
+    return [r + [""]*(n-len(r)) if len(r) < n else r for r in rows]
+
 def round2_decimal(d: Decimal) -> Decimal:
     return d.quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
 
 def normalize_text(s: Any) -> str:
     if s is None:
         return ""
-    t = str(s)
+    return _normalize_str(str(s))
+
+@lru_cache(maxsize=4096)
+def _normalize_str(t: str) -> str:
     t = t.strip()
     # NFKC not required; collapse whitespace & lowercase
-    t = re.sub(r'\s+', ' ', t)
+    t = _WS_RE.sub(' ', t)
     return t.lower()
 
+class _KeepAmountChars(dict):
+    # str.translate table: keep digits, '.' and '-', drop everything else (incl. non-latin currency signs)
+    def __missing__(self, key):
+        self[key] = None
+        return None
+
+_AMT_TT = _KeepAmountChars((ord(c), ord(c)) for c in "0123456789.-")
+
 def parse_amount(raw: Any) -> Decimal:
+    if isinstance(raw, Decimal):
+        return raw
+    if type(raw) is int:
+        # plain int cells skip string cleaning; bool and float go through str() below,
+        # so True, nan and exponent forms clean exactly as their string form does
+        return Decimal(raw)
     s = "" if raw is None else str(raw)
-    cleaned = re.sub(r'[^0-9.\-]', '', s)
+    cleaned = s.translate(_AMT_TT)
     if cleaned in ("", ".", "-"):
         return Decimal("0")
     try:
@@ -45,52 +79,135 @@ def parse_amount(raw: Any) -> Decimal:
     except:
         return Decimal("0")
 
+# amounts are summed as exact integer micro-units and rounded once per total, like summing Decimals
+_AMOUNT_DECIMALS = 6
+_AMOUNT_SCALE = 10 ** _AMOUNT_DECIMALS
+
+def _parse_units(raw: Any) -> Optional[int]:
+    # hot-loop variant of parse_amount: the same value as an exact int of 1/_AMOUNT_SCALE units,
+    # or None when it has more fraction digits than that (callers fall back to parse_amount)
+    if type(raw) is int:
+        return raw * _AMOUNT_SCALE
+    m = _AMT_PARTS_RE.fullmatch(("" if raw is None else str(raw)).translate(_AMT_TT))
+    if m is None:
+        return 0
+    sign, whole, frac = m.groups()
+    if not whole and not frac:
+        return 0
+    if frac and len(frac) > _AMOUNT_DECIMALS:
+        return None
+    units = int(whole or "0") * _AMOUNT_SCALE + int((frac or "").ljust(_AMOUNT_DECIMALS, "0"))
+    return -units if sign else units
+
+_MONTHS = ("January","February","March","April","May","June","July","August","September","October","November","December")
+_MONTH_ABBR = {m[:3].lower(): i for i,m in enumerate(_MONTHS)}
+
 def parse_month_string(s: str) -> Optional[Dict[str,Any]]:
     if not s:
         return None
     s = str(s).strip()
-    months = [
-        "January","February","March","April","May","June","July","August","September","October","November","December"
-    ]
-    m = re.match(r'^([A-Za-z]+)\s+(\d{4})$', s)
+    m = _MONTH_RE1.match(s)
     if m:
-        mon = m.group(1)
+        key = m.group(1)[:3].lower()
+        midx = _MONTH_ABBR.get(key)
+        if midx is None and len(key) < 3:
+            # 1-2 letter tokens match by prefix, first month wins ("Ma" -> March, "J" -> January)
+            midx = next((i for i,mn in enumerate(_MONTHS) if mn.lower().startswith(key)), None)
         yr = int(m.group(2))
-        for idx,mn in enumerate(months):
-            if mn.lower().startswith(mon[:3].lower()):
-                # last day:
-                if idx == 11:
-                    last_day = 31
-                else:
-                    next_month = date(yr, idx+2, 1)
-                    last_day = (next_month - timedelta(days=1)).day
-                return {"year":yr,"monthName":months[idx],"lastDay":last_day,"lastDate":date(yr, idx+1, last_day)}
-    m2 = re.match(r'^(\d{1,2})[\/\-](\d{4})$', s)
-    if m2:
+    else:
+        m2 = _MONTH_RE2.match(s)
+        if not m2:
+            return None
         midx = int(m2.group(1))-1
-        if 0 <= midx <= 11:
-            yr = int(m2.group(2))
-            if midx == 11:
-                last_day = 31
-            else:
-                next_month = date(yr, midx+2, 1)
-                last_day = (next_month - timedelta(days=1)).day
-            return {"year":yr,"monthName":months[midx],"lastDay":last_day,"lastDate":date(yr, midx+1, last_day)}
-    return None
+        yr = int(m2.group(2))
+    if midx is None or not 0 <= midx <= 11:
+        return None
+    last_day = calendar.monthrange(yr, midx+1)[1]
+    return {"year":yr,"monthName":_MONTHS[midx],"lastDay":last_day,"lastDate":date(yr, midx+1, last_day)}
 
 # ---------- Sheets helpers (assumes googleapiclient sheets.spreadsheets() client passed) ----------
+def col_to_a1(col_idx: int) -> str:
+    # col_idx is 0-based; returns A/B/.../AA etc.
+    s = ""
+    n = col_idx + 1
+    while n > 0:
+        n, r = divmod(n-1, 26)
+        s = chr(65 + r) + s
+    return s
+
+SHEETS_META_TTL = 60.0  # seconds; one metadata fetch serves every step of a run
+_props_cache: Dict[str, Tuple[float, Dict[str, Tuple[int,int]]]] = {}
+
+def list_sheets_props(sheets_client, spreadsheet_id: str) -> Dict[str, Tuple[int,int]]:
+    # title -> (rowCount, columnCount), in tab order
+    hit = _props_cache.get(spreadsheet_id)
+    if hit and time.monotonic() - hit[0] < SHEETS_META_TTL:
+        return hit[1]
+    props = _fetch_sheets_props(sheets_client, spreadsheet_id)
+    _props_cache[spreadsheet_id] = (time.monotonic(), props)
+    return props
+
 @retry(max_attempts=3, backoff=1.0)
+def _fetch_sheets_props(sheets_client, spreadsheet_id: str) -> Dict[str, Tuple[int,int]]:
+    meta = sheets_client.get(spreadsheetId=spreadsheet_id, includeGridData=False,
+                             fields="sheets(properties(title,gridProperties(rowCount,columnCount)))").execute()
+    props: Dict[str, Tuple[int,int]] = {}
+    for s in meta.get('sheets', []):
+        p = s.get('properties', {})
+        grid = p.get('gridProperties', {})
+        props[p.get('title', '')] = (int(grid.get('rowCount', 0)), int(grid.get('columnCount', 0)))
+    return props
+
 def list_sheets_titles(sheets_client, spreadsheet_id: str) -> List[str]:
-    meta = sheets_client.get(spreadsheetId=spreadsheet_id, fields="sheets(properties(title))").execute()
-    return [s['properties']['title'] for s in meta.get('sheets', [])]
+    return list(list_sheets_props(sheets_client, spreadsheet_id))
+
+def bounded_range(title: str, props: Dict[str, Tuple[int,int]], max_cols: int = 26, max_rows: int = 9999) -> str:
+    # tighten A1:<max_col><max_row> to the tab's actual grid so sparse tabs don't ship empty cells
+    rows, cols = props.get(title, (max_rows, max_cols))
+    rows = min(rows or max_rows, max_rows)
+    cols = min(cols or max_cols, max_cols)
+    return f"'{title}'!A1:{col_to_a1(cols-1)}{rows}"
 
 @retry(max_attempts=3, backoff=1.0)
 def read_values(sheets_client, spreadsheet_id: str, a1_range: str) -> List[List[Any]]:
-    res = sheets_client.values().get(spreadsheetId=spreadsheet_id, range=a1_range, majorDimension='ROWS').execute()
+    res = sheets_client.values().get(spreadsheetId=spreadsheet_id, range=a1_range, majorDimension='ROWS',
+                                      fields='values').execute()
     return res.get('values', [])
 
+BATCH_GET_CHUNK = 50   # ranges per batchGet; keeps each response well under the API's payload cap
+BATCH_GET_WORKERS = 8
+
+def _execute_isolated(request):
+    # discovery requests share one httplib2.Http, which is not thread-safe;
+    # give each worker its own connection with the same credentials
+    creds = getattr(request.http, 'credentials', None)
+    if creds is None:
+        return request.execute()
+    return request.execute(http=google_auth_httplib2.AuthorizedHttp(creds, http=httplib2.Http()))
+
+@retry(max_attempts=3, backoff=1.0)
+def _batch_get(sheets_client, spreadsheet_id: str, ranges: List[str], isolated: bool=False) -> List[List[List[Any]]]:
+    req = sheets_client.values().batchGet(spreadsheetId=spreadsheet_id, ranges=ranges, majorDimension='ROWS',
+                                          fields='valueRanges(values)')
+    res = _execute_isolated(req) if isolated else req.execute()
+    return [vr.get('values', []) for vr in res.get('valueRanges', [])]
+
+def batch_read_values(sheets_client, spreadsheet_id: str, ranges: List[str]) -> List[List[List[Any]]]:
+    # one round-trip for many ranges; results come back in request order.
+    # Large range lists are split into chunks fetched concurrently.
+    if not ranges:
+        return []
+    if len(ranges) <= BATCH_GET_CHUNK:
+        return _batch_get(sheets_client, spreadsheet_id, ranges)
+    chunks = [ranges[i:i+BATCH_GET_CHUNK] for i in range(0, len(ranges), BATCH_GET_CHUNK)]
+    with ThreadPoolExecutor(max_workers=min(BATCH_GET_WORKERS, len(chunks))) as ex:
+        parts = list(ex.map(lambda c: _batch_get(sheets_client, spreadsheet_id, c, isolated=True), chunks))
+    return [vals for part in parts for vals in part]
+
 @retry(max_attempts=3, backoff=1.0)
 def append_values(sheets_client, spreadsheet_id: str, a1_range: str, values: List[List[Any]]):
+    # INSERT_ROWS grows the grid, so cached row counts for this spreadsheet are stale
+    _props_cache.pop(spreadsheet_id, None)
     body = {"values": values}
     return sheets_client.values().append(spreadsheetId=spreadsheet_id, range=a1_range,
                                          valueInputOption='RAW', insertDataOption='INSERT_ROWS', body=body).execute()
@@ -101,6 +218,14 @@ def update_values(sheets_client, spreadsheet_id: str, a1_range: str, values: Lis
     return sheets_client.values().update(spreadsheetId=spreadsheet_id, range=a1_range,
                                          valueInputOption='RAW', body=body).execute()
 
+@retry(max_attempts=3, backoff=1.0)
+def batch_update_values(sheets_client, spreadsheet_id: str, updates: List[Dict[str,Any]]):
+    # updates: [{"range": a1, "values": [[...]]}, ...] written in a single request
+    if not updates:
+        return None
+    body = {"valueInputOption": "RAW", "data": updates}
+    return sheets_client.values().batchUpdate(spreadsheetId=spreadsheet_id, body=body).execute()
+
 # ---------- friendly course name (optimized map) ----------
 COURSE_MAP = [
     ("master 25-26", "Data Analytics"),
@@ -120,21 +245,33 @@ COURSE_MAP = [
     ("fsd", "Full Stack Development"),
 ]
 
+@lru_cache(maxsize=4096)
 def friendly_course_name(sheet_name: str) -> str:
+    # COURSE_MAP order is the priority (first listed key wins, not first position in the title),
+    # so keep the ordered scan and memoize: titles come from a handful of tabs.
     if not sheet_name:
         return ""
     s = sheet_name.lower()
     for k,v in COURSE_MAP:
         if k in s:
             return v
-    cleaned = re.sub(r'master', '', sheet_name, flags=re.I).replace('_',' ').replace('-',' ').strip()
-    return " ".join([p.capitalize() for p in re.split(r'\s+', cleaned) if p])
+    # capitalize() lowercases the tail anyway, so lowercase first and drop 'master' without a regex
+    cleaned = sheet_name.lower().replace('master', '').translate(_UND_HYP_TT)
+    return " ".join(p.capitalize() for p in cleaned.split())
+
+def build_course_index(titles: List[str]) -> Dict[str, str]:
+    # classify every tab once up front; aggregators then do dict lookups
+    return {t: friendly_course_name(t) for t in titles}
 
 # ---------- Aggregation (optimized: list sheets + bulk reads) ----------
-def find_header_index(headers: List[str], keys: List[str]) -> int:
-    if not headers:
+def build_header_index(headers: List[Any]) -> List[str]:
+    # lowercase headers once per tab; pass the result to find_header_index for every lookup
+    return [str(h).lower() for h in headers]
+
+def find_header_index(low: List[str], keys: List[str]) -> int:
+    # substring match, first header wins (so an exact-name dict can't replace the scan)
+    if not low:
         return -1
-    low = [str(h).lower() for h in headers]
     for i,h in enumerate(low):
         for k in keys:
             if k in h:
@@ -142,48 +279,60 @@ def find_header_index(headers: List[str], keys: List[str]) -> int:
     return -1
 
 def aggregate_from_effort(sheets_client, effort_sheet_id: str, selected_month: str) -> Dict[str, Decimal]:
-    totals: Dict[str, Decimal] = {}
-    titles = list_sheets_titles(sheets_client, effort_sheet_id)
-    for title in titles:
-        if not re.search(r'master', title, re.I):
-            continue
-        # bulk read used range (A:Z to avoid overly large calls)
-        a1 = f"'{title}'!A1:Z9999"
-        vals = read_values(sheets_client, effort_sheet_id, a1)
+    totals: Dict[str, int] = defaultdict(int)   # 1/_AMOUNT_SCALE units
+    extra: Dict[str, Decimal] = {}   # rare amounts too precise for the integer units
+    month_want = str(selected_month).strip()
+    props = list_sheets_props(sheets_client, effort_sheet_id)
+    titles = [t for t in props if _MASTER_RE.search(t)]
+    # bulk read used range (capped at A:Z), all tabs in one batchGet
+    ranges = [bounded_range(t, props) for t in titles]
+    course_idx = build_course_index(titles)
+    for title, vals in zip(titles, batch_read_values(sheets_client, effort_sheet_id, ranges)):
         if not vals or len(vals) < 2:
             continue
-        headers = vals[0]
-        col_sme = find_header_index(headers, ["sme","instructor","name"])
-        col_month = find_header_index(headers, ["month"])
-        col_amt = find_header_index(headers, ["final round","final amount","amount"])
+        low = build_header_index(vals[0])
+        col_sme = find_header_index(low, ["sme","instructor","name"])
+        col_month = find_header_index(low, ["month"])
+        col_amt = find_header_index(low, ["final round","final amount","amount"])
         if col_sme == -1 or col_amt == -1:
             continue
-        course = friendly_course_name(title)
-        for row in vals[1:]:
-            month_cell = row[col_month] if col_month < len(row) else ""
-            if month_cell and str(month_cell).strip() != str(selected_month).strip():
+        course = course_idx[title]
+        # group per tab by SME only (course is fixed for the tab), merge into totals once per tab
+        tab_totals: Dict[str, int] = defaultdict(int)
+        data = pad_rows(vals[1:], max(col_sme, col_amt, col_month) + 1)
+        for row in data:
+            month_cell = row[col_month] if col_month >= 0 else ""
+            if month_cell and str(month_cell).strip() != month_want:
                 continue
-            sme = row[col_sme] if col_sme < len(row) else ""
-            if not sme or str(sme).strip()=="":
+            sme = row[col_sme]
+            if not sme:
                 continue
-            raw_amt = row[col_amt] if col_amt < len(row) else ""
-            amt = parse_amount(raw_amt)
-            key = f"{str(sme).strip()}|{course}"
-            totals[key] = totals.get(key, Decimal("0")) + amt
-    # normalize totals to Decimal and round
-    return {k: round2_decimal(v) for k,v in totals.items()}
+            sme = str(sme).strip()
+            if not sme:
+                continue
+            units = _parse_units(row[col_amt])
+            if units is None:
+                key = f"{sme}|{course}"
+                extra[key] = extra.get(key, Decimal("0")) + parse_amount(row[col_amt])
+                units = 0
+            tab_totals[sme] += units
+        for sme, units in tab_totals.items():
+            totals[f"{sme}|{course}"] += units
+    # exact sum as Decimal, rounded once per total
+    return {k: round2_decimal(Decimal(v).scaleb(-_AMOUNT_DECIMALS) + extra.get(k, Decimal("0")))
+            for k,v in totals.items()}
 
 # ---------- SME links map (normalized) ----------
 def build_sme_links_map(sheets_client, sme_sheet_id: str) -> Dict[str, Dict[str,Any]]:
-    titles = list_sheets_titles(sheets_client, sme_sheet_id)
+    props = list_sheets_props(sheets_client, sme_sheet_id)
+    titles = [t for t in props if t.lower() != 'onboarded']
     links_map: Dict[str, Dict[str,Any]] = {}
-    for title in titles:
-        if title.lower() == 'onboarded':
-            continue
-        a1 = f"'{title}'!A1:Z9999"
-        vals = read_values(sheets_client, sme_sheet_id, a1)
+    ranges = [bounded_range(t, props) for t in titles]
+    course_idx = build_course_index(titles)
+    for title, vals in zip(titles, batch_read_values(sheets_client, sme_sheet_id, ranges)):
         if not vals or len(vals) < 2:
             continue
+        course = course_idx[title]
         for r in vals[1:]:
             raw_name = r[0] if len(r)>0 else ""
             if not raw_name or str(raw_name).strip()=="":
@@ -194,12 +343,9 @@ def build_sme_links_map(sheets_client, sme_sheet_id: str) -> Dict[str, Dict[str,
             email = r[1] if len(r)>1 else ""
             if email and not links_map[name_norm]["__email"]:
                 links_map[name_norm]["__email"] = str(email).strip()
-            url = ""
-            # attempt to find url in row (common: col H or any cell that looks like https)
-            for cell in r[2:10]:  # small scan
-                if isinstance(cell, str) and re.match(r'^https?:\/\/', cell.strip(), re.I):
-                    url = cell.strip(); break
-            course = friendly_course_name(title)
+            # attempt to find url in row (common: col H or any cell that looks like https); prefix check, no regex
+            url = next((c.strip() for c in r[2:10]
+                        if isinstance(c, str) and c.lstrip()[:8].lower().startswith(('http://', 'https://'))), "")
             if url:
                 links_map[name_norm][course] = url
                 links_map[name_norm]["__any"].append(url)
@@ -237,18 +383,22 @@ def build_master_rows(totals: Dict[str, Decimal], selected_month: str) -> List[L
 # ---------- Populate tracker links (formula-based) ----------
 def populate_tracker_links_and_emails(sheets_client, master_sheet_id: str, links_map: Dict[str,Any], master_sheet_name='Master data'):
     # read A:J range
-    a1 = f"'{master_sheet_name}'!A1:J9999"
+    a1 = bounded_range(master_sheet_name, list_sheets_props(sheets_client, master_sheet_id), max_cols=10)
     vals = read_values(sheets_client, master_sheet_id, a1)
     if not vals or len(vals) < 2:
         return {"updated":0,"notFound":0,"emailsWritten":0}
-    header = vals[0]; data = vals[1:]
-    tracker_out = []
-    email_out = []
+    header = vals[0]; data = pad_rows(vals[1:], 10)
+    # only cells whose value actually changes are sent back
+    tracker_changes: List[Tuple[int,str]] = []
+    email_changes: List[Tuple[int,str]] = []
     updated = notFound = emailsWritten = 0
-    for row in data:
-        instr = row[1] if len(row)>1 else ""
-        course = row[2] if len(row)>2 else ""
-        instr_norm = normalize_text(instr)
+    norm_cache: Dict[str,str] = {}   # instructors repeat across rows; normalize each raw name once
+    for i,row in enumerate(data):
+        instr = row[1]
+        course = row[2]
+        instr_norm = norm_cache.get(instr)
+        if instr_norm is None:
+            instr_norm = norm_cache[instr] = normalize_text(instr)
         found_url = ""
         found_email = ""
         if instr_norm in links_map:
@@ -261,21 +411,18 @@ def populate_tracker_links_and_emails(sheets_client, master_sheet_id: str, links
             found_email = rec.get("__email","")
         # tracker formula
         if found_url:
-            tracker_out.append([f'=HYPERLINK("{found_url}","Tracker Link")'])
+            formula = f'=HYPERLINK("{found_url}","Tracker Link")'
+            if formula != row[3]:
+                tracker_changes.append((i, formula))
             updated += 1
-        else:
-            orig = row[3] if len(row)>3 else ""
-            tracker_out.append([orig if orig else ""])
-            if not orig:
-                notFound += 1
-        existing_email = row[9] if len(row)>9 else ""
-        if found_email and str(found_email).strip() != str(existing_email).strip():
-            email_out.append([found_email]); emailsWritten += 1
-        else:
-            email_out.append([existing_email if existing_email else ""])
-    # bulk write
-    update_values(sheets_client, master_sheet_id, f"'{master_sheet_name}'!D2:D{1+len(data)}", tracker_out)
-    update_values(sheets_client, master_sheet_id, f"'{master_sheet_name}'!J2:J{1+len(data)}", email_out)
+        elif not row[3]:
+            notFound += 1
+        if found_email and str(found_email).strip() != str(row[9]).strip():
+            email_changes.append((i, found_email)); emailsWritten += 1
+    # bulk write: one batchUpdate carrying only the changed cells
+    updates = [{"range": f"'{master_sheet_name}'!D{i+2}", "values": [[v]]} for i,v in tracker_changes]
+    updates += [{"range": f"'{master_sheet_name}'!J{i+2}", "values": [[v]]} for i,v in email_changes]
+    batch_update_values(sheets_client, master_sheet_id, updates)
     return {"updated":updated,"notFound":notFound,"emailsWritten":emailsWritten}
 
 # ---------- Invoice assignment (optimized, normalized matching with option to require exact) ----------
@@ -283,93 +430,91 @@ def assign_invoice_numbers(sheets_client, master_sheet_id: str, program_sheet_id
                            master_sheet_name='Master data', program_sheet_name=None,
                            month_filter: Optional[str]=None, exact_match: bool=False, force_overwrite: bool=False):
     # Read master sheet A:K
-    a1_master = f"'{master_sheet_name}'!A1:K9999"
+    a1_master = bounded_range(master_sheet_name, list_sheets_props(sheets_client, master_sheet_id), max_cols=11)
     master_vals = read_values(sheets_client, master_sheet_id, a1_master)
     if not master_vals or len(master_vals) < 2:
         return {"status":"empty"}
     header = master_vals[0]; rows = master_vals[1:]
     # find indices robustly (case-insensitive)
-    def index_of(hlist, candidates):
-        low = [str(h).lower() for h in hlist]
+    def index_of(low, candidates):
+        # candidate order wins here (unlike find_header_index); low comes from build_header_index
         for c in candidates:
             for i,hh in enumerate(low):
                 if c in hh:
                     return i
         return -1
-    col_month = index_of(header, ["month"])
-    col_sme = index_of(header, ["sme","instructor","name"])
-    col_invoice = index_of(header, ["invoice number","invoice"])
-    col_audit = index_of(header, ["invoice audit"])
+    low = build_header_index(header)
+    col_month = index_of(low, ["month"])
+    col_sme = index_of(low, ["sme","instructor","name"])
+    col_invoice = index_of(low, ["invoice number","invoice"])
+    col_audit = index_of(low, ["invoice audit"])
     if col_sme == -1: col_sme = 1
     if col_invoice == -1: col_invoice = 7  # fallback to H
+    rows = pad_rows(rows, max(col_month, col_sme, col_invoice, col_audit) + 1)
     # Read program sheet to build prevMax
-    prog_range = f"'{program_sheet_name}'!A1:Z9999" if program_sheet_name else "A1:Z9999"
+    prog_props = list_sheets_props(sheets_client, program_sheet_id)
+    # no name -> first tab, same as an unqualified A1 range
+    prog_title = program_sheet_name or next(iter(prog_props), None)
+    prog_range = bounded_range(prog_title, prog_props) if prog_title else "A1:Z9999"
     prog_vals = read_values(sheets_client, program_sheet_id, prog_range)
     if not prog_vals or len(prog_vals) < 2:
         return {"status":"no_program_rows"}
     prog_header = prog_vals[0]; prog_rows = prog_vals[1:]
-    prog_sme_idx = index_of(prog_header, ["sme name","sme name / company name","company name"])
-    prog_inv_idx = index_of(prog_header, ["invoice number","invoice"])
+    prog_low = build_header_index(prog_header)
+    prog_sme_idx = index_of(prog_low, ["sme name","sme name / company name","company name"])
+    prog_inv_idx = index_of(prog_low, ["invoice number","invoice"])
     if prog_sme_idx == -1: prog_sme_idx = 2
     if prog_inv_idx == -1: prog_inv_idx = 1
+    prog_rows = pad_rows(prog_rows, max(prog_sme_idx, prog_inv_idx) + 1)
     prev_max: Dict[str,int] = {}
     prog_refs: Dict[str,List[int]] = {}
     for i,row in enumerate(prog_rows):
-        name = row[prog_sme_idx] if prog_sme_idx < len(row) else ""
+        name = row[prog_sme_idx]
         if not name: continue
         key = name if exact_match else normalize_text(name)
-        inv_raw = row[prog_inv_idx] if prog_inv_idx < len(row) else ""
-        m = re.search(r'(\d+)', str(inv_raw))
+        inv_raw = row[prog_inv_idx]
+        m = _DIGITS_RE.search(str(inv_raw))
         num = int(m.group(1)) if m else 0
         if key not in prev_max or num > prev_max[key]:
             prev_max[key] = num
         prog_refs.setdefault(key, []).append(i+2)
-    # Group master rows that match program SMEs
-    groups: Dict[str,List[int]] = {}
-    for i,row in enumerate(rows):
-        sheet_row_number = i+2
-        if month_filter and col_month != -1:
-            month_val = row[col_month] if col_month < len(row) else ""
-            if str(month_val).strip() != str(month_filter).strip():
-                continue
-        name = row[col_sme] if col_sme < len(row) else ""
+    # Single pass over master rows: each matched SME keeps a running counter seeded from the
+    # program sheet's max, so rows are numbered in sheet order per SME (same as grouping first)
+    month_want = str(month_filter).strip() if month_filter and col_month != -1 else None
+    data_count = len(rows)
+    invoice_out = [[r[col_invoice]] for r in rows]
+    audit_out = [[r[col_audit] if col_audit >= 0 else ""] for r in rows]
+    next_nums: Dict[str,int] = {}
+    refs_str: Dict[str,str] = {}
+    matched = False
+    total_assigned = 0
+    for idx,row in enumerate(rows):
+        if month_want is not None and str(row[col_month]).strip() != month_want:
+            continue
+        name = row[col_sme]
         if not name: continue
         key = name if exact_match else normalize_text(name)
-        if key in prev_max:
-            groups.setdefault(key, []).append(sheet_row_number)
-    if not groups:
+        if key not in prev_max:
+            continue
+        matched = True
+        if invoice_out[idx][0] and not force_overwrite:
+            continue
+        next_num = next_nums.get(key) or prev_max[key] + 1
+        invoice_out[idx][0] = f"Invoice # {next_num}"
+        if col_audit >= 0:
+            refs = refs_str.get(key)
+            if refs is None:
+                refs = refs_str[key] = ','.join(map(str, prog_refs.get(key, []))) or 'none'
+            audit_out[idx][0] = f"MatchedProgramRows:{refs}; PrevInv:{prev_max[key]}; Assigned:{next_num}"
+        next_nums[key] = next_num + 1
+        total_assigned += 1
+    if not matched:
         return {"status":"no_matches"}
-    # prepare outputs for invoice and audit columns
-    data_count = len(rows)
-    invoice_out = [[rows[i][col_invoice] if col_invoice < len(rows[i]) else ""] for i in range(data_count)]
-    audit_out = [[rows[i][col_audit] if col_audit < len(rows[i]) else ""] for i in range(data_count)]
-    total_assigned = 0
-    for key, row_nums in groups.items():
-        next_num = (prev_max.get(key,0) or 0) + 1
-        refs = prog_refs.get(key, [])
-        for sheet_row in row_nums:
-            idx = sheet_row - 2
-            existing = invoice_out[idx][0]
-            if existing and not force_overwrite:
-                continue
-            invoice_out[idx][0] = f"Invoice # {next_num}"
-            if col_audit >= 0:
-                audit_out[idx][0] = f"MatchedProgramRows:{','.join(map(str,refs)) or 'none'}; PrevInv:{prev_max.get(key,0)}; Assigned:{next_num}"
-            next_num += 1
-            total_assigned += 1
     # write back
-    # convert column index to letter(s)
-    def col_to_a1(col_idx:int) -> str:
-        # col_idx is 0-based; returns A/B/.../AA etc.
-        s = ""
-        n = col_idx + 1
-        while n > 0:
-            n, r = divmod(n-1, 26)
-            s = chr(65 + r) + s
-        return s
     inv_col_letter = col_to_a1(col_invoice)
     audit_col_letter = col_to_a1(col_audit) if col_audit>=0 else None
-    update_values(sheets_client, master_sheet_id, f"'{master_sheet_name}'!{inv_col_letter}2:{inv_col_letter}{1+data_count}", invoice_out)
+    updates = [{"range": f"'{master_sheet_name}'!{inv_col_letter}2:{inv_col_letter}{1+data_count}", "values": invoice_out}]
     if audit_col_letter:
-        update_values(sheets_client, master_sheet_id, f"'{master_sheet_name}'!{audit_col_letter}2:{audit_col_letter}{1+data_count}", audit_out)
+        updates.append({"range": f"'{master_sheet_name}'!{audit_col_letter}2:{audit_col_letter}{1+data_count}", "values": audit_out})
+    batch_update_values(sheets_client, master_sheet_id, updates)
     return {"status":"ok","assigned":total_assigned}
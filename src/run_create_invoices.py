@@ -7,11 +7,23 @@ import os
 import re
 import json
 import sys
+import hashlib
+import threading
 from datetime import datetime
 from math import isfinite
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
+from functools import lru_cache
+import httplib2
+from google_auth_httplib2 import AuthorizedHttp
 from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
-from typing import List, Dict, Tuple
+from googleapiclient.model import JsonModel
+try:
+    import orjson
+except ImportError:  # optional: fall back to the stdlib parser
+    orjson = None
+from typing import List, Dict, Optional, Tuple
 
 # --- Config / column mapping (1-based columns) ---
 MASTER_SHEET_NAME = "Master data"
@@ -30,6 +42,14 @@ COL_INV_NUMBER = 8     # H
 COL_INV_DATED = 9      # I
 COL_EMAIL = 10         # J
 
+# --- Precompiled patterns (used in per-row loops) ---
+_RE_NONNUMERIC = re.compile(r"[^0-9\.\-]")
+_RE_MASTER = re.compile(r"master", re.I)
+_RE_SEP = re.compile(r"[_\-]+")
+_RE_WS = re.compile(r"\s+")
+_RE_DIGITS = re.compile(r"(\d+)")
+_RE_MONTH_YEAR = re.compile(r"([A-Za-z]+)\s+(\d{4})")
+
 # --- Scopes & env ---
 SCOPES = ["https://www.googleapis.com/auth/spreadsheets",
           "https://www.googleapis.com/auth/drive"]
@@ -39,31 +59,189 @@ EFFORT_SHEET_ID = os.environ.get("EFFORT_SHEET_ID")
 SME_SHEET_ID = os.environ.get("SME_SHEET_ID")
 PROGRAM_SHEET_ID = os.environ.get("PROGRAM_SHEET_ID")
 GCP_SA_KEY = os.environ.get("GCP_SA_KEY")
+# SME links map is cached here between runs, keyed by the SME spreadsheet's Drive version
+CACHE_DIR = os.environ.get("INVOICE_CACHE_DIR") or os.path.join(os.path.expanduser("~"), ".cache", "invoice_automation")
 
 if not GCP_SA_KEY:
     raise SystemExit("Missing GCP_SA_KEY env")
 
 # --- Helpers: Authorization / Sheets client ---
-def get_sheets_service():
-    info = json.loads(GCP_SA_KEY)
-    creds = Credentials.from_service_account_info(info, scopes=SCOPES)
-    service = build("sheets", "v4", credentials=creds)
+def json_loads(content):
+    return orjson.loads(content) if orjson is not None else json.loads(content)
+
+class FastJsonModel(JsonModel):
+    """
+    JsonModel that decodes API response bodies with orjson (values payloads are the bulk of parse time).
+    Same behavior as JsonModel.deserialize otherwise.
+    """
+    def deserialize(self, content):
+        if orjson is None:
+            return super().deserialize(content)
+        try:
+            body = orjson.loads(content)
+        except orjson.JSONDecodeError:
+            return content.decode("utf-8") if isinstance(content, bytes) else content
+        if self._data_wrapper and "data" in body:
+            body = body["data"]
+        return body
+
+def get_credentials():
+    info = json_loads(GCP_SA_KEY)
+    return Credentials.from_service_account_info(info, scopes=SCOPES)
+
+def build_sheets_service():
+    # static_discovery uses the discovery doc bundled with the client (no HTTP fetch),
+    # cache_discovery=False skips the file-cache lookup
+    creds = get_credentials()
+    service = build("sheets", "v4", credentials=creds, model=FastJsonModel(),
+                    static_discovery=True, cache_discovery=False)
     return service
 
-# Utility: find col index by keywords in header (0-based)
-def find_col(headers: List[str], keywords: List[str]) -> int:
-    hlower = [str(h or "").lower() for h in headers]
-    for i, h in enumerate(hlower):
-        for k in keywords:
-            if k in h:
-                return i
-    return -1
+@lru_cache(maxsize=1)
+def get_sheets_service():
+    # one shared service per process; threads that need their own call build_sheets_service()
+    return build_sheets_service()
+
+def get_drive_service():
+    return build("drive", "v3", credentials=get_credentials(), model=FastJsonModel(),
+                 static_discovery=True, cache_discovery=False)
+
+# Max ranges per spreadsheets.values.batchGet request
+BATCH_GET_CHUNK = 100
+# Concurrent batchGet requests in flight
+FETCH_WORKERS = 8
+# googleapiclient retries 429/5xx with exponential backoff when num_retries > 0
+API_RETRIES = 5
+
+# Only tab titles and grid sizes: the default spreadsheets.get response carries all sheet metadata
+SHEET_PROPS_FIELDS = "sheets.properties(title,sheetId,gridProperties(rowCount,columnCount))"
 
-def round2(n):
+def a1_sheet(title: str) -> str:
+    # quote a tab title for A1 notation (embedded quotes are doubled)
+    return "'" + title.replace("'", "''") + "'"
+
+def _encode_col(n: int) -> str:
+    # 0-based column index -> A1 letters, base-26 (A..Z, AA..ZZ, AAA..)
+    s = ""
+    n += 1
+    while n:
+        n, r = divmod(n - 1, 26)
+        s = chr(65 + r) + s
+    return s
+
+# A..ZZ precomputed (indexes 0..701)
+_COL_CACHE = tuple(_encode_col(i) for i in range(702))
+
+def _col_letter(n: int) -> str:
+    return _COL_CACHE[n] if 0 <= n < len(_COL_CACHE) else _encode_col(n)
+
+def sheet_range(props: Dict, max_rows: int, max_cols: int, first_row: int = 1) -> str:
+    """
+    A1 range for a tab clamped to its actual grid (gridProperties), capped at max_rows x max_cols.
+    """
+    grid = props.get("gridProperties", {})
+    rows = min(grid.get("rowCount") or max_rows, max_rows)
+    cols = min(grid.get("columnCount") or max_cols, max_cols)
+    return f"{a1_sheet(props.get('title', ''))}!A{first_row}:{_col_letter(cols - 1)}{max(rows, first_row)}"
+
+# Worker threads live for the whole process, and each keeps its own keep-alive connection,
+# so repeated batchGets reuse TLS sessions instead of reconnecting per request
+_fetch_pool = None
+_thread_http = threading.local()
+
+def fetch_pool() -> ThreadPoolExecutor:
+    global _fetch_pool
+    if _fetch_pool is None:
+        _fetch_pool = ThreadPoolExecutor(max_workers=FETCH_WORKERS, thread_name_prefix="sheets-fetch")
+    return _fetch_pool
+
+def execute_isolated(request):
+    # the discovery client's shared httplib2.Http is not thread-safe: each worker thread uses its own
+    creds = getattr(request.http, "credentials", None)
+    if creds is None:
+        return request.execute(num_retries=API_RETRIES)
+    http = getattr(_thread_http, "http", None)
+    if http is None or http.credentials is not creds:
+        http = _thread_http.http = AuthorizedHttp(creds, http=httplib2.Http())
+    return request.execute(http=http, num_retries=API_RETRIES)
+
+def retryable_error(e: Exception) -> bool:
+    # 429/5xx and transport errors: execute(num_retries=API_RETRIES) already retried these, so callers
+    # should give up rather than fan out more requests; other HttpErrors (e.g. 400 bad range) are per-request
+    status = getattr(getattr(e, "resp", None), "status", None)
     try:
-        return round(float(n) + 1e-9, 2)
-    except Exception:
-        return 0.0
+        return status is None or int(status) == 429 or int(status) >= 500
+    except (TypeError, ValueError):
+        return True
+
+def batch_get_values(svc, spreadsheet_id: str, ranges: List[str]) -> List[List[List]]:
+    """
+    Fetch many A1 ranges with spreadsheets.values.batchGet, BATCH_GET_CHUNK ranges per request,
+    with up to FETCH_WORKERS requests in flight.
+    Returns one values list per range, in request order.
+    """
+    chunks = [ranges[i:i + BATCH_GET_CHUNK] for i in range(0, len(ranges), BATCH_GET_CHUNK)]
+    def fetch(chunk):
+        req = svc.spreadsheets().values().batchGet(spreadsheetId=spreadsheet_id, ranges=chunk, majorDimension="ROWS")
+        resp = execute_isolated(req) if len(chunks) > 1 else req.execute(num_retries=API_RETRIES)
+        return [vr.get("values", []) for vr in resp.get("valueRanges", [])]
+    if len(chunks) <= 1:
+        return [v for chunk in chunks for v in fetch(chunk)]
+    return [v for part in fetch_pool().map(fetch, chunks) for v in part]
+
+def batch_update_values(svc, spreadsheet_id: str, data: List[Dict], value_input_option: str = "RAW"):
+    """
+    Write several ranges in one spreadsheets.values.batchUpdate request.
+    data: [{"range": a1, "values": [[...]]}, ...]; valueInputOption applies to every range.
+    """
+    if not data:
+        return None
+    return svc.spreadsheets().values().batchUpdate(
+        spreadsheetId=spreadsheet_id,
+        body={"valueInputOption": value_input_option, "data": data}
+    ).execute(num_retries=API_RETRIES)
+
+def changed_runs(col_letter: str, new_cells: List[List], old_values: List, first_row: int = 2) -> List[Dict]:
+    """
+    Diff a single-column write against the values already in the sheet.
+    Returns batchUpdate data entries covering only runs of consecutive changed rows.
+    """
+    data = []
+    pairs = enumerate(new_cells)
+    for changed, run in groupby(pairs, key=lambda p: p[1][0] != old_values[p[0]]):
+        if not changed:
+            continue
+        run = list(run)
+        start, end = first_row + run[0][0], first_row + run[-1][0]
+        data.append({
+            "range": f"'{MASTER_SHEET_NAME}'!{col_letter}{start}:{col_letter}{end}",
+            "values": [cell for _, cell in run],
+            "majorDimension": "ROWS",
+        })
+    return data
+
+# Utility: find col indexes by keywords in header (0-based), all groups in one pass over the headers
+def find_cols(headers: List[str], groups: Dict[str, List[str]]) -> Dict[str, int]:
+    """
+    For each group, the first header containing any of its keywords; -1 if none.
+    """
+    found = {name: -1 for name in groups}
+    pending = dict(groups)
+    for i, h in enumerate(str(h or "").lower() for h in headers):
+        for name, keywords in list(pending.items()):
+            if any(k in h for k in keywords):
+                found[name] = i
+                del pending[name]
+        if not pending:
+            break
+    return found
+
+# header keywords for effort tabs
+EFFORT_COLS = {
+    "sme": ["sme", "instructor", "name"],
+    "month": ["month"],
+    "final": ["final round", "final amount", "amount"],
+}
 
 # --- 1) Read month from Config!A1 ---
 def read_month_from_config(svc) -> str:
@@ -87,31 +265,44 @@ def aggregate_from_effort(svc, selected_month: str) -> Dict[Tuple[str,str], floa
     """
     totals = {}
     # read spreadsheet metadata to iterate sheets
-    meta = svc.spreadsheets().get(spreadsheetId=EFFORT_SHEET_ID).execute()
-    sheets = meta.get("sheets", [])
-    for sh in sheets:
-        title = sh.get("properties", {}).get("title", "")
-        if not re.search(r"master", title, re.I):
-            continue
-        # read the sheet range fully (safe approach: get used range)
-        # Get gridProperties to know rowCount/colCount? We'll request a large block (1..lastRow,lastCol)
-        sheet_title = title.replace("'", "\\'")
-        # read first 500 rows (like Apps Script)
-        rng = f"'{title}'!A1:Z500"
+    meta = svc.spreadsheets().get(spreadsheetId=EFFORT_SHEET_ID, fields=SHEET_PROPS_FIELDS).execute()
+    props = [sh.get("properties", {}) for sh in meta.get("sheets", [])]
+    props = [p for p in props if _RE_MASTER.search(p.get("title", ""))]
+    titles = [p.get("title", "") for p in props]
+    # read first 500 rows (like Apps Script) of every master tab in one batchGet, clamped to each tab's grid
+    ranges = [sheet_range(p, 500, 26) for p in props]
+    try:
+        tab_values = batch_get_values(svc, EFFORT_SHEET_ID, ranges)
+    except Exception as e:
+        # rate limits / server errors were already retried: fail the run instead of reporting an empty month
+        if retryable_error(e):
+            raise
+        print("Warning reading effort sheets:", e)
+        # otherwise read tab by tab so one bad tab is skipped on its own, as before
+        def fetch_tab(args):
+            title, rng = args
+            try:
+                req = svc.spreadsheets().values().get(spreadsheetId=EFFORT_SHEET_ID, range=rng)
+                return execute_isolated(req).get("values", [])
+            except Exception as e:
+                print("Warning reading sheet", title, ":", e)
+                return []
+        tab_values = list(fetch_pool().map(fetch_tab, zip(titles, ranges)))
+    for title, data in zip(titles, tab_values):
         try:
-            resp = svc.spreadsheets().values().get(spreadsheetId=EFFORT_SHEET_ID, range=rng).execute()
-            data = resp.get("values", [])
             if not data or len(data) < 2:
                 continue
             headers = [str(h or "") for h in data[0]]
-            col_sme = find_col(headers, ["sme", "instructor", "name"])
-            col_month = find_col(headers, ["month"])
-            col_final = find_col(headers, ["final round", "final amount", "amount"])
+            cols = find_cols(headers, EFFORT_COLS)
+            col_sme, col_month, col_final = cols["sme"], cols["month"], cols["final"]
             if col_sme == -1 or col_final == -1:
                 continue
+            # subtotal per SME within the tab (course is constant per tab), merged into totals below
+            course = friendly_course_name(title)
+            tab_totals = {}
             for row in data[1:]:
-                month_cell = row[col_month] if col_month < len(row) else ""
-                if str(month_cell).strip() == "" or str(month_cell).strip() != selected_month:
+                month_cell = str(row[col_month]).strip() if col_month < len(row) else ""
+                if month_cell == "" or month_cell != selected_month:
                     continue
                 sme = str(row[col_sme]).strip() if col_sme < len(row) else ""
                 if not sme:
@@ -119,11 +310,12 @@ def aggregate_from_effort(svc, selected_month: str) -> Dict[Tuple[str,str], floa
                 raw_amt = row[col_final] if col_final < len(row) else ""
                 amt = 0.0
                 try:
-                    amt_text = re.sub(r"[^0-9\.\-]", "", str(raw_amt) or "0")
+                    amt_text = _RE_NONNUMERIC.sub("", str(raw_amt) or "0")
                     amt = float(amt_text) if amt_text not in ("", ".", "-") else 0.0
                 except Exception:
                     amt = 0.0
-                course = friendly_course_name(title)
+                tab_totals[sme] = tab_totals.get(sme, 0.0) + amt
+            for sme, amt in tab_totals.items():
                 key = (sme, course)
                 totals[key] = totals.get(key, 0.0) + amt
         except Exception as e:
@@ -132,85 +324,148 @@ def aggregate_from_effort(svc, selected_month: str) -> Dict[Tuple[str,str], floa
     return totals
 
 # friendly_course_name replicates Apps Script mapping heuristics
+# Order matters: the first listed key contained in the title wins (e.g. "master data science"
+# must hit "master data science" before "da"), so this stays an ordered scan rather than a
+# position-based multi-pattern match.
+COURSE_MAP_PAIRS = (
+    ("master 25-26", "Data Analytics"),
+    ("master 25 26", "Data Analytics"),
+    ("master comm", "Community Live Classes"),
+    ("master community", "Community Live Classes"),
+    ("master ds", "Data Science"),
+    ("master data science", "Data Science"),
+    ("master da", "Data Analytics"),
+    ("da", "Data Analytics"),
+    ("data analytics", "Data Analytics"),
+    ("ds", "Data Science"),
+    ("gen ai", "Generative AI"),
+    ("genai", "Generative AI"),
+    ("master gen ai", "Generative AI"),
+    ("master fsd", "Full Stack Development"),
+    ("fsd", "Full Stack Development"),
+    ("full stack", "Full Stack Development"),
+    ("master full stack", "Full Stack Development"),
+)
+
+@lru_cache(maxsize=None)
 def friendly_course_name(sheet_name: str) -> str:
     if not sheet_name:
         return ""
     s = sheet_name.lower()
-    map_pairs = [
-        ("master 25-26", "Data Analytics"),
-        ("master 25 26", "Data Analytics"),
-        ("master comm", "Community Live Classes"),
-        ("master community", "Community Live Classes"),
-        ("master ds", "Data Science"),
-        ("master data science", "Data Science"),
-        ("master da", "Data Analytics"),
-        ("da", "Data Analytics"),
-        ("data analytics", "Data Analytics"),
-        ("ds", "Data Science"),
-        ("gen ai", "Generative AI"),
-        ("genai", "Generative AI"),
-        ("master gen ai", "Generative AI"),
-        ("master fsd", "Full Stack Development"),
-        ("fsd", "Full Stack Development"),
-        ("full stack", "Full Stack Development"),
-        ("master full stack", "Full Stack Development"),
-    ]
-    for k,v in map_pairs:
+    for k,v in COURSE_MAP_PAIRS:
         if k in s:
             return v
     # fallback: remove "master" and title-case
-    cleaned = re.sub(r"master", "", sheet_name, flags=re.I)
-    cleaned = re.sub(r"[_\-]+", " ", cleaned).strip()
+    cleaned = _RE_MASTER.sub("", sheet_name)
+    cleaned = _RE_SEP.sub(" ", cleaned).strip()
     parts = [w.capitalize() for w in cleaned.split() if w.strip()]
     return " ".join(parts) or sheet_name
 
 # --- 3) Build SME links map from SME management sheet ---
+# Per-cell display text and link target only; the rest of the grid payload is dropped
+SME_GRID_FIELDS = "sheets(properties(title),data(rowData(values(formattedValue,hyperlink))))"
+
+def grid_rows(sheet: Dict, max_rows: int) -> List[List[Dict]]:
+    """
+    Rows of cell dicts ({'formattedValue', 'hyperlink'}) from a spreadsheets.get grid,
+    trimmed like values.get: at most max_rows, no trailing empty rows.
+    """
+    rows = []
+    for block in sheet.get("data", []):
+        rows.extend(rd.get("values", []) for rd in block.get("rowData", []))
+    rows = rows[:max_rows]
+    while rows and not any(c.get("formattedValue") for c in rows[-1]):
+        rows.pop()
+    return rows
+
+def fetch_sme_grids(svc, ranges: Dict[str, str]) -> Dict[str, Optional[List[List[Dict]]]]:
+    """
+    Read {title: A1 range} from the SME workbook with spreadsheets.get(includeGridData), so column H
+    comes with its hyperlink. One request for all tabs; if it fails with a per-request error (e.g. 400),
+    tabs are retried one request each and a tab that still fails maps to None instead of emptying the
+    whole result. After a 429/5xx every tab maps to None.
+    """
+    def fetch(rngs, isolated):
+        req = svc.spreadsheets().get(spreadsheetId=SME_SHEET_ID, ranges=rngs, includeGridData=True,
+                                     fields=SME_GRID_FIELDS)
+        resp = execute_isolated(req) if isolated else req.execute(num_retries=API_RETRIES)
+        return {sh.get("properties", {}).get("title", ""): grid_rows(sh, 5000) for sh in resp.get("sheets", [])}
+    try:
+        got = fetch(list(ranges.values()), False)
+        return {t: got.get(t, []) for t in ranges}
+    except Exception as e:
+        print("Warning fetching SME sheets", e)
+        # already retried: don't hit a rate-limited / failing API once per tab
+        if retryable_error(e):
+            return {t: None for t in ranges}
+    def fetch_one(item):
+        title, rng = item
+        try:
+            return fetch([rng], True).get(title, [])
+        except Exception as e:
+            print("Warning fetching SME sheet", title, e)
+            return None
+    return dict(zip(ranges, fetch_pool().map(fetch_one, ranges.items())))
+
 def build_sme_links_map(svc) -> Dict[str, Dict]:
     """
     Returns linksMap keyed by normalized instructor name -> record dict:
       { '__any': [urls], '__email': email, '__courses': [courseNames], '<CourseName>': url }
+    'complete' is False when the fetch or a tab failed and the map may be missing rows.
     Normalization: NFKC + lower + collapse spaces
     """
     links_map = {}
-    # Read entire sheet (first ~5000 rows safe)
-    rng = "A1:Z5000"
-    resp = svc.spreadsheets().values().get(spreadsheetId=SME_SHEET_ID, range=rng).execute()
-    data = resp.get("values", [])
-    if not data or len(data) < 2:
-        return {"linksMap": links_map, "rowsScanned": 0}
-    # We assume first row is header; iterate through sheets in SME_SS where each sheet is a course
-    # But since SME_SHEET_ID is a single spreadsheet with multiple tabs, we need to fetch sheet names to iterate tabs
-    meta = svc.spreadsheets().get(spreadsheetId=SME_SHEET_ID).execute()
-    sheets = meta.get("sheets", [])
     rows_scanned = 0
-    for sh in sheets:
-        title = sh.get("properties", {}).get("title", "")
-        # skip "Onboarded" etc if present per Apps Script
-        if title.lower() == "onboarded":
+    complete = True  # False when a fetch or tab failed; such maps are not cached
+    try:
+        meta = svc.spreadsheets().get(spreadsheetId=SME_SHEET_ID,
+                                      fields=SHEET_PROPS_FIELDS).execute(num_retries=API_RETRIES)
+    except Exception as e:
+        print("Warning fetching SME sheets", e)
+        return {"linksMap": links_map, "rowsScanned": rows_scanned, "complete": False}
+    props = [sh.get("properties", {}) for sh in meta.get("sheets", [])]
+    titles = [p.get("title", "") for p in props]
+    if not titles:
+        return {"linksMap": links_map, "rowsScanned": 0, "complete": True}
+    # iterate through tabs in SME_SS where each sheet is a course; skip "Onboarded" etc per Apps Script
+    course_titles = [t for t in titles if t.lower() != "onboarded"]
+    # course tabs are read as A1:H5000, the first tab (the probe) as A1:Z5000, each clamped to its grid:
+    # unlike values.get, spreadsheets.get rejects ranges past the sheet's rowCount/columnCount
+    ranges = {p.get("title", ""): sheet_range(p, 5000, 8) for p in props if p.get("title", "") in course_titles}
+    ranges[titles[0]] = sheet_range(props[0], 5000, 26)
+    grids = fetch_sme_grids(svc, ranges)
+    # We assume first row is header; the first tab must have data rows
+    probe = grids.get(titles[0])
+    if probe is None:
+        return {"linksMap": links_map, "rowsScanned": 0, "complete": False}
+    if len(probe) < 2:
+        return {"linksMap": links_map, "rowsScanned": 0, "complete": True}
+    for title in course_titles:
+        if grids.get(title) is None:
+            complete = False
             continue
+        # A2:H as before
+        rows = [r[:8] for r in grids[title][1:]]
         friendly = friendly_course_name(title)
-        # read this sheet
-        rng_s = f"'{title}'!A2:H5000"
         try:
-            resp_s = svc.spreadsheets().values().get(spreadsheetId=SME_SHEET_ID, range=rng_s).execute()
-            rows = resp_s.get("values", [])
             for r in rows:
                 if not r or len(r) == 0:
                     continue
-                raw_name = r[0]
+                raw_name = r[0].get("formattedValue", "")
                 if not raw_name or str(raw_name).strip() == "":
                     continue
                 rows_scanned += 1
                 name_norm = normalize_name(raw_name)
                 if name_norm not in links_map:
                     links_map[name_norm] = {"__any": [], "__email": "", "__courses": []}
-                candidate_email = (r[1] if len(r) > 1 else "") or ""
+                candidate_email = (r[1].get("formattedValue", "") if len(r) > 1 else "") or ""
                 if candidate_email and not links_map[name_norm]["__email"]:
                     links_map[name_norm]["__email"] = str(candidate_email).strip()
-                # column H (index 7) is the rich/url cell in Apps Script; here we check index 7 (0-based)
+                # column H (index 7) is the rich/url cell in Apps Script: use its hyperlink when set
+                # (rich-text links show plain text), else a plain URL typed into the cell
                 url = ""
                 if len(r) >= 8:
-                    cand = r[7]
+                    cand = r[7].get("hyperlink") or r[7].get("formattedValue", "")
                     if isinstance(cand, str) and cand.strip().lower().startswith("http"):
                         url = cand.strip()
                 # fallback: sometimes column 8 may be a plain URL in other columns - ignore for now
@@ -221,18 +476,74 @@ def build_sme_links_map(svc) -> Dict[str, Dict]:
                     links_map[name_norm]["__courses"].append(friendly)
         except Exception as e:
             print("Warning fetching SME sheet", title, e)
+            complete = False
             continue
-    return {"linksMap": links_map, "rowsScanned": rows_scanned}
+    return {"linksMap": links_map, "rowsScanned": rows_scanned, "complete": complete}
+
+# in-process reuse of the cached map, keyed by fingerprint
+_sme_map_memo: Dict[str, Dict] = {}
+# part of the fingerprint: bump whenever build_sme_links_map's output changes
+SME_MAP_CACHE_FORMAT = 1
+
+def sme_sheet_fingerprint() -> str:
+    # Drive's file version increases on every edit, unlike sheet metadata
+    f = get_drive_service().files().get(fileId=SME_SHEET_ID, fields="version,modifiedTime",
+                                        supportsAllDrives=True).execute()
+    raw = f"{SME_MAP_CACHE_FORMAT}:{SME_SHEET_ID}:{f.get('version', '')}:{f.get('modifiedTime', '')}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+
+def load_sme_links_map(svc, cancelled: Optional[threading.Event] = None) -> Dict[str, Dict]:
+    """
+    build_sme_links_map, reused from CACHE_DIR while the SME spreadsheet is unchanged.
+    Falls back to a fresh build if the fingerprint can't be read; incomplete builds are never cached.
+    If `cancelled` is set before a build is needed, an empty incomplete map is returned instead.
+    """
+    def build():
+        if cancelled is not None and cancelled.is_set():
+            return {"linksMap": {}, "rowsScanned": 0, "complete": False}
+        return build_sme_links_map(svc)
+    try:
+        fp = sme_sheet_fingerprint()
+    except Exception as e:
+        print("Warning: SME map cache disabled:", e)
+        return build()
+    if fp in _sme_map_memo:
+        return _sme_map_memo[fp]
+    path = os.path.join(CACHE_DIR, f"sme_map_{fp}.json")
+    try:
+        with open(path, "r", encoding="utf-8") as fh:
+            info = json.load(fh)
+    except (OSError, ValueError):
+        info = build()
+        if not info.get("complete"):
+            return info
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            tmp = path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as fh:
+                json.dump(info, fh)
+            os.replace(tmp, path)
+            # drop maps for older versions of the sheet
+            for name in os.listdir(CACHE_DIR):
+                if name.startswith("sme_map_") and name != os.path.basename(path):
+                    os.remove(os.path.join(CACHE_DIR, name))
+        except OSError as e:
+            print("Warning: could not write SME map cache:", e)
+    _sme_map_memo[fp] = info
+    return info
 
 def normalize_name(x):
-    return re.sub(r"\s+", " ", str(x or "").strip()).lower()
+    # coerce first so the cache only ever sees hashable strings
+    return _normalize_name_str(str(x or ""))
+
+@lru_cache(maxsize=100_000)
+def _normalize_name_str(x: str) -> str:
+    return _RE_WS.sub(" ", x.strip()).lower() if x else ""
 
 # --- 4) Append master rows to Master data ---
 def append_master_rows(svc, rows: List[List]):
     if not rows:
         return {"status":"empty","written":0}
-    # fetch current header to detect insertion row
-    meta = svc.spreadsheets().get(spreadsheetId=MASTER_SHEET_ID).execute()
     # append at bottom
     range_append = f"'{MASTER_SHEET_NAME}'!A1"
     # Use valueInputOption RAW so numbers remain numbers where possible
@@ -246,18 +557,27 @@ def append_master_rows(svc, rows: List[List]):
     return {"status":"ok","written": written}
 
 # --- 5) Populate tracker links and emails (writes =HYPERLINK(url,"Tracker Link") into D; email into J) ---
-def populate_tracker_links_and_emails(svc):
-    # Read master sheet range A:J first ~5000 rows
+def populate_tracker_links_and_emails(svc, sme_info=None):
+    # Read master sheet range A:J first ~5000 rows, plus column D again with FORMULA render
+    # (so existing HYPERLINK cells compare equal to what we would write); renderOption is per
+    # request, so the D read runs alongside on the fetch pool and B, C, J stay formatted values
     rng = f"'{MASTER_SHEET_NAME}'!A1:J5000"
+    tracker_req = svc.spreadsheets().values().get(spreadsheetId=MASTER_SHEET_ID, range=f"'{MASTER_SHEET_NAME}'!D2:D5000",
+                                                  majorDimension="COLUMNS", valueRenderOption="FORMULA")
+    tracker_future = fetch_pool().submit(execute_isolated, tracker_req)
     resp = svc.spreadsheets().values().get(spreadsheetId=MASTER_SHEET_ID, range=rng, majorDimension="ROWS").execute()
     data = resp.get("values", [])
+    tracker_cols = tracker_future.result().get("values", [])
     if not data or len(data) < 2:
         return {"updated":0,"notFound":0,"emailsWritten":0,"unmatchedSample":[]}
     headers = data[0]
     rows = data[1:]
     num = len(rows)
-    # Build links map once
-    sme_info = build_sme_links_map(svc)
+    old_tracker = (tracker_cols[0] if tracker_cols else [])[:num]
+    old_tracker += [""] * (num - len(old_tracker))
+    # Build links map once (unless the caller prefetched it)
+    if sme_info is None:
+        sme_info = load_sme_links_map(svc)
     links_map = sme_info.get("linksMap", {})
     tracker_out = []
     email_out = []
@@ -265,7 +585,7 @@ def populate_tracker_links_and_emails(svc):
     notFound = 0
     emailsWritten = 0
     unmatchedSample = []
-    for r in rows:
+    for r, existing in zip(rows, old_tracker):
         instr = r[COL_SME-1] if len(r) >= COL_SME else ""
         course = r[COL_COURSE-1] if len(r) >= COL_COURSE else ""
         instr_norm = normalize_name(instr)
@@ -287,7 +607,6 @@ def populate_tracker_links_and_emails(svc):
             updated += 1
         else:
             # keep existing D value if present
-            existing = r[COL_TRACKER-1] if len(r) >= COL_TRACKER else ""
             tracker_out.append([existing if existing else ""])
             if not existing:
                 notFound += 1
@@ -298,19 +617,11 @@ def populate_tracker_links_and_emails(svc):
             emailsWritten += 1
         else:
             email_out.append([existing_email if existing_email else ""])
-    # perform batch updates: columns D and J
-    svc.spreadsheets().values().update(
-        spreadsheetId=MASTER_SHEET_ID,
-        range=f"'{MASTER_SHEET_NAME}'!D2:D{1+num}",
-        valueInputOption="USER_ENTERED",
-        body={"values": tracker_out}
-    ).execute()
-    svc.spreadsheets().values().update(
-        spreadsheetId=MASTER_SHEET_ID,
-        range=f"'{MASTER_SHEET_NAME}'!J2:J{1+num}",
-        valueInputOption="RAW",
-        body={"values": email_out}
-    ).execute()
+    # perform batch updates: only the changed runs of columns D and J
+    # (valueInputOption is per request: HYPERLINK formulas need USER_ENTERED, emails stay RAW)
+    old_email = [r[COL_EMAIL-1] if len(r) >= COL_EMAIL else "" for r in rows]
+    batch_update_values(svc, MASTER_SHEET_ID, changed_runs("D", tracker_out, old_tracker), value_input_option="USER_ENTERED")
+    batch_update_values(svc, MASTER_SHEET_ID, changed_runs("J", email_out, old_email), value_input_option="RAW")
     # build unmatched sample
     for idx, outcell in enumerate(tracker_out[:30]):
         t = outcell[0] if outcell and len(outcell)>0 else ""
@@ -323,8 +634,8 @@ def populate_tracker_links_and_emails(svc):
 def assign_invoice_numbers_exact_match(svc, force_overwrite=False, month_filter=None):
     # Read master sheet fully (A..J)
     rng_master = f"'{MASTER_SHEET_NAME}'!A1:K5000"
-    resp = svc.spreadsheets().values().get(spreadsheetId=MASTER_SHEET_ID, range=rng_master).execute()
-    vals = resp.get("values", [])
+    # plus the full header row, so an audit column past K (or past Z) is still found
+    vals, wide_header = batch_get_values(svc, MASTER_SHEET_ID, [rng_master, f"'{MASTER_SHEET_NAME}'!1:1"])
     if not vals or len(vals) < 2:
         print("No data in master")
         return {"assigned":0}
@@ -366,93 +677,106 @@ def assign_invoice_numbers_exact_match(svc, force_overwrite=False, month_filter=
     # build prevMaxInvoice map (exact string keys)
     prevMaxInvoice = {}
     matchedProgramRows = {}
-    for i, r in enumerate(prog_vals[1:]):
-        rawName = str(r[prog_sme_idx]) if prog_sme_idx < len(r) else ""
-        if rawName is None or str(rawName).strip() == "":
+    for i, r in enumerate(prog_vals[1:], start=2):  # i = sheet row (1-based)
+        key = str(r[prog_sme_idx]) if prog_sme_idx < len(r) else ""
+        if not key.strip():
             continue
-        key = str(rawName)
         rawInv = r[prog_inv_idx] if prog_inv_idx < len(r) else ""
-        num = 0
-        if rawInv not in ("", None):
-            m = re.search(r"(\d+)", str(rawInv))
-            if m:
-                try:
-                    num = int(m.group(1))
-                except:
-                    num = 0
-        prevMaxInvoice[key] = max(prevMaxInvoice.get(key, 0), num)
-        matchedProgramRows.setdefault(key, []).append(i+2)  # sheet rows (1-based)
-    # group master rows by exact SME name but only for SMEs present in prevMaxInvoice
-    groups = {}
+        # \d+ always parses as int, so no try/except around the conversion
+        m = _RE_DIGITS.search(str(rawInv)) if rawInv not in ("", None) else None
+        num = int(m.group(1)) if m else 0
+        # one lookup per row: first sighting seeds both maps, later rows only raise the max
+        refs = matchedProgramRows.get(key)
+        if refs is None:
+            refs = matchedProgramRows[key] = []
+            prevMaxInvoice[key] = num
+        elif num > prevMaxInvoice[key]:
+            prevMaxInvoice[key] = num
+        refs.append(i)
+    # Build invoiceOut and auditOut arrays size = dataRowCount
+    dataRowCount = len(rows)
+    invoiceOut = [[rows[i][col_invoice_index] if col_invoice_index < len(rows[i]) else ""] for i in range(dataRowCount)]
+    audit_out = [[""] for _ in range(dataRowCount)]
+    # single pass over master rows (exact SME name, only SMEs present in prevMaxInvoice):
+    # each SME keeps a running counter, so numbering per SME follows sheet order as before
+    month_want = str(month_filter).strip() if month_filter else None
+    nextNums = {}
+    auditRefs = {}
+    matched = False
+    total_assigned = 0
     for idx, row in enumerate(rows):
-        sheet_row_num = idx + 2
-        if month_filter and col_month_index < len(row):
-            if str(row[col_month_index]).strip() != str(month_filter).strip():
+        if month_want is not None and col_month_index < len(row):
+            if str(row[col_month_index]).strip() != month_want:
                 continue
         rawSme = row[col_sme_index] if col_sme_index < len(row) else ""
         if rawSme in ("", None):
             continue
         key = str(rawSme)
-        if key in prevMaxInvoice:
-            groups.setdefault(key, []).append(sheet_row_num)
-    if not groups:
+        if key not in prevMaxInvoice:
+            continue
+        matched = True
+        if invoiceOut[idx][0] and not force_overwrite:
+            continue
+        nextNum = nextNums.get(key) or prevMaxInvoice[key] + 1
+        invoiceOut[idx][0] = f"Invoice # {nextNum}"
+        refs = auditRefs.get(key)
+        if refs is None:
+            refs = auditRefs[key] = ','.join(map(str, matchedProgramRows.get(key, []))) or 'none'
+        audit_out[idx][0] = f"MatchedProgramRows:{refs}; PrevInv:{prevMaxInvoice[key]}; Assigned:{nextNum}"
+        nextNums[key] = nextNum + 1
+        total_assigned += 1
+    if not matched:
         print("No master rows to update (no matching SMEs in program sheet)")
         return {"assigned":0}
-    # Build invoiceOut and auditOut arrays size = dataRowCount
-    dataRowCount = len(rows)
-    invoiceOut = [[rows[i][col_invoice_index] if col_invoice_index < len(rows[i]) else ""] for i in range(dataRowCount)]
-    audit_out = [["" for _ in range(1)] for _ in range(dataRowCount)]
-    total_assigned = 0
-    for key, sheet_rows_for_key in groups.items():
-        nextNum = (prevMaxInvoice.get(key, 0) or 0) + 1
-        prog_refs = matchedProgramRows.get(key, [])
-        for sheetRow in sheet_rows_for_key:
-            zero_idx = sheetRow - 2
-            existingInv = invoiceOut[zero_idx][0]
-            if existingInv and not force_overwrite:
-                continue
-            invString = f"Invoice # {nextNum}"
-            invoiceOut[zero_idx][0] = invString
-            auditVal = f"MatchedProgramRows:{','.join(map(str,prog_refs)) or 'none'}; PrevInv:{prevMaxInvoice.get(key,0)}; Assigned:{nextNum}"
-            audit_out[zero_idx][0] = auditVal
-            nextNum += 1
-            total_assigned += 1
-    # write back invoice column and audit if any
+    # write back invoice column and audit if any, in one batchUpdate (changed runs only)
     # invoice column is H -> 8 -> range start row 2 column 8
-    svc.spreadsheets().values().update(
-        spreadsheetId=MASTER_SHEET_ID,
-        range=f"'{MASTER_SHEET_NAME}'!H2:H{1+dataRowCount}",
-        valueInputOption="RAW",
-        body={"values": invoiceOut}
-    ).execute()
+    old_inv = [r[COL_INV_NUMBER-1] if len(r) >= COL_INV_NUMBER else "" for r in rows]
+    data = changed_runs("H", invoiceOut, old_inv)
     # Audit column: if header had 'Invoice Audit (ProgramRow_INV3)' then we should find it; for now write to column K if present
     # Attempt to find audit header index
     audit_idx = -1
-    for i,h in enumerate(headers):
+    for i,h in enumerate(wide_header[0] if wide_header else headers):
         if isinstance(h,str) and "Invoice Audit".lower() in h.lower():
             audit_idx = i
             break
     if audit_idx >= 0:
-        col_letter = chr(ord('A') + audit_idx)
-        svc.spreadsheets().values().update(
-            spreadsheetId=MASTER_SHEET_ID,
-            range=f"'{MASTER_SHEET_NAME}'!{col_letter}2:{col_letter}{1+dataRowCount}",
-            valueInputOption="RAW",
-            body={"values": audit_out}
-        ).execute()
+        col_letter = _col_letter(audit_idx)
+        if audit_idx < 11:
+            old_audit = [r[audit_idx] if audit_idx < len(r) else "" for r in rows]
+        else:
+            # outside the A:K read: fetch the audit column itself to diff against
+            audit_resp = svc.spreadsheets().values().get(
+                spreadsheetId=MASTER_SHEET_ID, range=f"'{MASTER_SHEET_NAME}'!{col_letter}2:{col_letter}{len(rows) + 1}",
+                majorDimension="COLUMNS").execute(num_retries=API_RETRIES)
+            audit_col = audit_resp.get("values", [[]])
+            old_audit = (audit_col[0] if audit_col else [])[:len(rows)]
+            old_audit += [""] * (len(rows) - len(old_audit))
+        data += changed_runs(col_letter, audit_out, old_audit)
+    batch_update_values(svc, MASTER_SHEET_ID, data, value_input_option="RAW")
     return {"assigned": total_assigned}
 
 # --- Orchestration ---
 def run(selected_month: str):
     svc = get_sheets_service()
+    # Fetch the SME links map in the background while effort data is aggregated.
+    # It gets its own service: the discovery client is not thread-safe.
+    skip_prefetch = threading.Event()
+    sme_future = fetch_pool().submit(lambda: load_sme_links_map(build_sheets_service(), cancelled=skip_prefetch))
+    def drop_prefetch():
+        # nothing will use the map: stop before the SME fetch so exit doesn't wait on it
+        skip_prefetch.set()
+        sme_future.cancel()
     print("Aggregating from effort for:", selected_month)
-    totals = aggregate_from_effort(svc, selected_month)
-    rows = []
+    try:
+        totals = aggregate_from_effort(svc, selected_month)
+    except Exception:
+        drop_prefetch()
+        raise
     tz = "UTC"
     parsed_period = None
     # build period & invoice dates approximations
     # If Apps Script parseMonthString was used, we produce a similar period string if month like 'September 2025'
-    m = re.match(r"([A-Za-z]+)\s+(\d{4})", selected_month)
+    m = _RE_MONTH_YEAR.match(selected_month)
     if m:
         monthName = m.group(1)
         year = int(m.group(2))
@@ -472,20 +796,16 @@ def run(selected_month: str):
         period = selected_month
         invoiceLastDate = datetime.utcnow().strftime("%d %m %Y")
         invoiceDated = invoiceLastDate
-    for (sme, course), amount in totals.items():
-        rows.append([
-            selected_month,   # A Month
-            sme,              # B SME
-            course,           # C Course
-            "",               # D tracker (to be filled)
-            round2(amount),   # E Amount
-            period,           # F Period
-            invoiceLastDate,  # G Invoice Last Date
-            "",               # H Invoice Number (assigned later)
-            invoiceDated,     # I Invoice Dated
-            ""                # J Email (to be updated)
-        ])
+    # totals as parallel columns; aggregate_from_effort only yields floats, rounded to 2 dp (+1e-9 nudges .xx5 up)
+    smes = [sme for sme, _ in totals]
+    courses = [course for _, course in totals]
+    amounts = [round(a + 1e-9, 2) for a in totals.values()]
+    # A Month, B SME, C Course, D tracker (to be filled), E Amount, F Period, G Invoice Last Date,
+    # H Invoice Number (assigned later), I Invoice Dated, J Email (to be updated)
+    rows = [[selected_month, s, c, "", a, period, invoiceLastDate, "", invoiceDated, ""]
+            for s, c, a in zip(smes, courses, amounts)]
     if not rows:
+        drop_prefetch()
         print("No data found for that month.")
         return {"status":"empty"}
     print("Appending", len(rows), "rows to Master data")
@@ -493,7 +813,7 @@ def run(selected_month: str):
     print("Append result:", append_res)
     # populate tracker links & emails (best-effort)
     try:
-        pop = populate_tracker_links_and_emails(svc)
+        pop = populate_tracker_links_and_emails(svc, sme_info=sme_future.result())
         print("Populate tracker result:", pop.get("updated"), "updated,", pop.get("emailsWritten"), "emails")
     except Exception as e:
         print("Populate failed:", e)